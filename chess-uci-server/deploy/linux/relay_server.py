@@ -9,7 +9,7 @@ Protocol:
   After pairing, data is piped bidirectionally until either side disconnects.
 
 Usage:
-  python relay_server.py [--port 19000] [--max-sessions 100]
+  python relay_server.py [--port 19000] [--max-sessions 100] [--coalesce]
 
 License: GPL-3.0
 """
@@ -18,31 +18,115 @@ import argparse
 import asyncio
 import logging
 import time
+import weakref
 
-# Session storage: session_id -> {server_reader, server_writer, registered_at, paired_event}
-sessions = {}
-sessions_lock = asyncio.Lock()
+logger = logging.getLogger(__name__)
 
 MAX_SESSIONS = 100
 STALE_TIMEOUT = 3600  # 1 hour
+HANDSHAKE_MAX_BYTES = 256  # SESSION <id> <role>\n is ~40 bytes in practice
+# Upper bound per pipe() read. read() returns whatever is already buffered,
+# so a burst of engine output is forwarded in one write instead of 4 KiB
+# slices, while a lone UCI line still goes out as soon as it arrives.
+READ_CHUNK = 64 * 1024
+
+# Optional write coalescing in pipe() (--coalesce). Reads are buffered and
+# written together once COALESCE_LIMIT bytes accumulate, a chunk ends a
+# line, or no more data arrives within COALESCE_DELAY seconds.
+COALESCE_WRITES = False
+COALESCE_LIMIT = 32 * 1024
+COALESCE_DELAY = 0.005
+
+
+class Session:
+    """A registered server waiting for (or paired with) a client.
+
+    Uses __slots__ to keep per-session overhead small on relays that hold
+    many concurrent sessions. pair_future resolves to the client's
+    (reader, writer) when a client pairs, or to None when a reconnecting
+    server supersedes this session.
+    """
+
+    __slots__ = ("server_reader", "server_writer", "registered_at",
+                 "pair_future")
+
+    def __init__(self, server_reader, server_writer, pair_future,
+                 registered_at=None):
+        self.server_reader = server_reader
+        self.server_writer = server_writer
+        self.registered_at = time.time() if registered_at is None else registered_at
+        self.pair_future = pair_future
 
+    @property
+    def client_writer(self):
+        """The paired client's writer, or None if not paired."""
+        future = self.pair_future
+        if future.done() and not future.cancelled() and future.result():
+            return future.result()[1]
+        return None
+
+
+# Session storage: session_id -> Session
+sessions = {}
+sessions_lock = asyncio.Lock()
 
-async def pipe(reader, writer, label=""):
-    """Pipe data from reader to writer until EOF or error."""
+
+# Writers already closed by this module; checked instead of polling
+# transport state via is_closing() on every teardown path.
+_closed_writers = weakref.WeakSet()
+
+
+def close_writer(writer):
+    """Close a stream writer at most once (None is ignored)."""
+    if writer is None or writer in _closed_writers:
+        return
+    _closed_writers.add(writer)
+    writer.close()
+
+
+async def pipe(reader, writer, label="", coalesce=None):
+    """Pipe data from reader to writer until EOF or error.
+
+    With coalescing (default: COALESCE_WRITES), small reads are merged into
+    one write. Newline-terminated chunks flush immediately so UCI command
+    turnaround is unaffected; partial data waits at most COALESCE_DELAY.
+    """
+    if coalesce is None:
+        coalesce = COALESCE_WRITES
+    buf = bytearray()
     try:
         while True:
-            data = await reader.read(4096)
+            if buf:
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_CHUNK), COALESCE_DELAY)
+                except asyncio.TimeoutError:
+                    writer.write(bytes(buf))
+                    buf.clear()
+                    await writer.drain()
+                    continue
+            else:
+                data = await reader.read(READ_CHUNK)
             if not data:
+                if buf:
+                    writer.write(bytes(buf))
+                    await writer.drain()
                 break
-            writer.write(data)
-            await writer.drain()
+            if not coalesce:
+                writer.write(data)
+                await writer.drain()
+                continue
+            buf += data
+            if len(buf) >= COALESCE_LIMIT or data.endswith(b"\n"):
+                writer.write(bytes(buf))
+                buf.clear()
+                await writer.drain()
     except (ConnectionResetError, BrokenPipeError, asyncio.CancelledError):
         pass
     except Exception as e:
-        logging.debug(f"Pipe {label} error: {e}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Pipe %s error: %s", label, e)
     finally:
-        if not writer.is_closing():
-            writer.close()
+        close_writer(writer)
 
 
 async def handle_server_role(session_id, reader, writer):
@@ -56,72 +140,52 @@ async def handle_server_role(session_id, reader, writer):
         if session_id in sessions:
             # Server reconnection: close old connections, replace session
             old = sessions[session_id]
-            old_server_writer = old.get("server_writer")
-            old_client_writer = old.get("client_writer")
-            old_event = old.get("paired_event")
 
             # Close old server connection
-            if old_server_writer and not old_server_writer.is_closing():
-                old_server_writer.close()
+            close_writer(old.server_writer)
             # Close old client connection if paired
-            if old_client_writer and not old_client_writer.is_closing():
-                old_client_writer.close()
+            close_writer(old.client_writer)
             # Wake up old handler so it can exit cleanly
-            if old_event and not old_event.is_set():
-                old_event.set()
+            if not old.pair_future.done():
+                old.pair_future.set_result(None)
 
-            logging.info(f"Session {session_id}: server reconnected (replaced old)")
+            logger.info("Session %s: server reconnected (replaced old)", session_id)
 
         elif len(sessions) >= MAX_SESSIONS:
             writer.write(b"ERROR max sessions reached\n")
             await writer.drain()
-            writer.close()
+            close_writer(writer)
             return
 
-        paired_event = asyncio.Event()
-        sessions[session_id] = {
-            "server_reader": reader,
-            "server_writer": writer,
-            "registered_at": time.time(),
-            "paired_event": paired_event,
-            "client_reader": None,
-            "client_writer": None,
-        }
+        # Our own future doubles as the supersession marker
+        my_future = asyncio.get_running_loop().create_future()
+        sessions[session_id] = Session(reader, writer, my_future)
 
     writer.write(b"REGISTERED\n")
     await writer.drain()
-    logging.info(f"Session {session_id}: server registered")
-
-    # Capture our own event reference for supersession detection
-    my_event = paired_event
+    logger.info("Session %s: server registered", session_id)
 
     # Wait for a client to pair
     try:
-        await my_event.wait()
+        pair = await my_future
     except asyncio.CancelledError:
         async with sessions_lock:
             sessions.pop(session_id, None)
-        writer.close()
+        close_writer(writer)
         return
 
     # Check if we were superseded by a newer server reconnection
     async with sessions_lock:
         session = sessions.get(session_id)
-        if not session or session["paired_event"] is not my_event:
+        if pair is None or not session or session.pair_future is not my_future:
             # Superseded: a newer server took over this session ID
-            if not writer.is_closing():
-                writer.close()
+            close_writer(writer)
             return
-        if not session["client_reader"]:
-            sessions.pop(session_id, None)
-            writer.close()
-            return
-        client_reader = session["client_reader"]
-        client_writer = session["client_writer"]
+    client_reader, client_writer = pair
 
     writer.write(b"PAIRED\n")
     await writer.drain()
-    logging.info(f"Session {session_id}: paired, starting data relay")
+    logger.info("Session %s: paired, starting data relay", session_id)
 
     # Bidirectional pipe
     try:
@@ -133,9 +197,8 @@ async def handle_server_role(session_id, reader, writer):
         async with sessions_lock:
             sessions.pop(session_id, None)
         for w in [writer, client_writer]:
-            if not w.is_closing():
-                w.close()
-        logging.info(f"Session {session_id}: relay ended")
+            close_writer(w)
+        logger.info("Session %s: relay ended", session_id)
 
 
 async def handle_client_role(session_id, reader, writer):
@@ -145,18 +208,21 @@ async def handle_client_role(session_id, reader, writer):
         if not session:
             writer.write(b"ERROR unknown session\n")
             await writer.drain()
-            writer.close()
+            close_writer(writer)
+            return
+        if session.pair_future.done():
+            writer.write(b"ERROR session already paired\n")
+            await writer.drain()
+            close_writer(writer)
             return
 
-        session["client_reader"] = reader
-        session["client_writer"] = writer
+        # Queue CONNECTED before handing off so it precedes any piped data,
+        # then pass our streams to the server handler in one step
+        writer.write(b"CONNECTED\n")
+        session.pair_future.set_result((reader, writer))
 
-    writer.write(b"CONNECTED\n")
     await writer.drain()
-    logging.info(f"Session {session_id}: client connected")
-
-    # Signal the server that we're paired
-    session["paired_event"].set()
+    logger.info("Session %s: client connected", session_id)
 
     # The server handler does the actual piping; client just waits
     # until the connection ends (pipe handles cleanup)
@@ -166,13 +232,39 @@ async def handle_client_role(session_id, reader, writer):
         pass
 
 
+async def read_handshake(reader):
+    """Read the SESSION handshake line, capped at HANDSHAKE_MAX_BYTES.
+
+    The relay's streams are created with limit=HANDSHAKE_MAX_BYTES, so
+    readuntil() rejects a client streaming bytes without a newline once the
+    cap is passed. Bytes pipelined after the newline stay buffered in the
+    reader for pipe().
+
+    Returns the line (including newline), b"" on EOF, or None if no newline
+    arrived within the cap.
+    """
+    try:
+        return await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError:
+        return b""
+    except asyncio.LimitOverrunError:
+        return None
+
+
 async def handle_connection(reader, writer):
-    """Dispatch incoming connection to server or client role."""
-    peername = writer.get_extra_info("peername")
+    """Dispatch incoming connection to server or client role.
+
+    The peer address is only looked up on the error paths that log it.
+    """
     try:
-        line = await asyncio.wait_for(reader.readline(), timeout=10)
+        line = await asyncio.wait_for(read_handshake(reader), timeout=10)
+        if line is None:
+            writer.write(b"ERROR handshake too long\n")
+            await writer.drain()
+            close_writer(writer)
+            return
         if not line:
-            writer.close()
+            close_writer(writer)
             return
 
         text = line.decode().strip()
@@ -181,7 +273,7 @@ async def handle_connection(reader, writer):
         if len(parts) != 3 or parts[0] != "SESSION":
             writer.write(b"ERROR invalid protocol\n")
             await writer.drain()
-            writer.close()
+            close_writer(writer)
             return
 
         session_id = parts[1]
@@ -194,45 +286,47 @@ async def handle_connection(reader, writer):
         else:
             writer.write(b"ERROR invalid role\n")
             await writer.drain()
-            writer.close()
+            close_writer(writer)
 
     except asyncio.TimeoutError:
-        logging.warning(f"Connection from {peername}: protocol timeout")
-        writer.close()
+        logger.warning("Connection from %s: protocol timeout",
+                       writer.get_extra_info("peername"))
+        close_writer(writer)
     except Exception as e:
-        logging.error(f"Connection from {peername} error: {e}")
-        if not writer.is_closing():
-            writer.close()
+        logger.error("Connection from %s error: %s",
+                     writer.get_extra_info("peername"), e)
+        close_writer(writer)
 
 
 async def cleanup_stale_sessions():
     """Periodically remove sessions older than STALE_TIMEOUT."""
     while True:
         await asyncio.sleep(300)  # Check every 5 minutes
-        now = time.time()
+        # Registered before the cutoff means older than STALE_TIMEOUT
+        cutoff = time.time() - STALE_TIMEOUT
         async with sessions_lock:
             stale = [
                 sid for sid, s in sessions.items()
-                if now - s["registered_at"] > STALE_TIMEOUT
+                if s.registered_at < cutoff
             ]
             for sid in stale:
                 session = sessions.pop(sid)
-                for key in ["server_writer", "client_writer"]:
-                    w = session.get(key)
-                    if w and not w.is_closing():
-                        w.close()
-                logging.info(f"Session {sid}: cleaned up (stale)")
+                for w in (session.server_writer, session.client_writer):
+                    close_writer(w)
+                logger.info("Session %s: cleaned up (stale)", sid)
 
 
-async def run_server(port, max_sessions):
+async def run_server(port, max_sessions, coalesce=False):
     """Start the relay server."""
-    global MAX_SESSIONS
+    global MAX_SESSIONS, COALESCE_WRITES
     MAX_SESSIONS = max_sessions
+    COALESCE_WRITES = coalesce
 
-    server = await asyncio.start_server(handle_connection, "0.0.0.0", port)
+    server = await asyncio.start_server(handle_connection, "0.0.0.0", port,
+                                        limit=HANDSHAKE_MAX_BYTES)
     addr = server.sockets[0].getsockname()
-    logging.info(f"Relay server listening on {addr[0]}:{addr[1]} "
-                 f"(max {max_sessions} sessions)")
+    logger.info("Relay server listening on %s:%s (max %d sessions)",
+                addr[0], addr[1], max_sessions)
 
     cleanup_task = asyncio.create_task(cleanup_stale_sessions())
 
@@ -249,6 +343,13 @@ def main():
                         help="TCP port to listen on (default: 19000)")
     parser.add_argument("--max-sessions", type=int, default=100,
                         help="Maximum concurrent sessions (default: 100)")
+    # Paired store_true/store_false flags (BooleanOptionalAction is 3.9+)
+    parser.add_argument("--coalesce", dest="coalesce", action="store_true",
+                        help="Merge small relayed reads into fewer writes "
+                             "(default: off)")
+    parser.add_argument("--no-coalesce", dest="coalesce", action="store_false",
+                        help="Forward each read as its own write")
+    parser.set_defaults(coalesce=False)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -256,7 +357,7 @@ def main():
         format="%(asctime)s [%(levelname)s] %(message)s",
     )
 
-    asyncio.run(run_server(args.port, args.max_sessions))
+    asyncio.run(run_server(args.port, args.max_sessions, args.coalesce))
 
 
 if __name__ == "__main__":
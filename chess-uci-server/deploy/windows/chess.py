@@ -7,6 +7,9 @@ License: GPL-3.0 (compatible with DroidFish)
 """
 
 import asyncio
+import bisect
+import copy
+import functools
 import hashlib
 import hmac
 import json
@@ -20,10 +23,33 @@ import ssl
 import stat
 import subprocess
 import sys
+import threading
 import time
 import ipaddress
 import re
-from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+# orjson is optional: a faster drop-in for parsing config.json and compact
+# serialization of pairing payloads. orjson.JSONDecodeError subclasses
+# json.JSONDecodeError, so callers catch the stdlib exception either way.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data):
+    """Parse JSON from str or bytes (orjson when available)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    """Serialize obj to compact JSON text (orjson when available)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
 
 # ---------------------------------------------------------------------------
 # Configuration validation
@@ -78,6 +104,17 @@ OPTIONAL_CONFIG_DEFAULTS = {
     "default_engine": "",
 }
 
+# Defaults split once: immutable values are shared as-is, only mutable
+# ones are deep-copied into each config
+_SHARED_DEFAULTS = {
+    key: value for key, value in OPTIONAL_CONFIG_DEFAULTS.items()
+    if not isinstance(value, (dict, list))
+}
+_COPIED_DEFAULTS = {
+    key: value for key, value in OPTIONAL_CONFIG_DEFAULTS.items()
+    if key not in _SHARED_DEFAULTS
+}
+
 # Default relay server for NAT traversal (used by setup wizard and installers)
 DEFAULT_RELAY_URL = "spacetosurf.com"
 DEFAULT_RELAY_PORT = 19000
@@ -89,9 +126,22 @@ def derive_session_id(server_secret, engine_name):
     Returns a 24-char hex string (matching existing token_hex(12) format).
     Same inputs always produce the same output; unpredictable without the secret.
     """
-    return hmac.new(
-        server_secret.encode(), engine_name.encode(), hashlib.sha256
-    ).hexdigest()[:24]
+    return derive_session_ids(server_secret, [engine_name])[engine_name]
+
+
+def derive_session_ids(server_secret, engine_names):
+    """derive_session_id for several engines sharing one secret.
+
+    The keyed HMAC state is built once and copied per name, instead of
+    re-keying for every engine. Returns {engine_name: session_id}.
+    """
+    keyed = hmac.new(server_secret.encode(), digestmod=hashlib.sha256)
+    ids = {}
+    for name in engine_names:
+        h = keyed.copy()
+        h.update(name.encode())
+        ids[name] = h.hexdigest()[:24]
+    return ids
 
 
 def ensure_server_secret(config, config_path="config.json"):
@@ -111,13 +161,76 @@ def ensure_server_secret(config, config_path="config.json"):
     return secret
 
 
+def _path_signature(path):
+    """Return a stat-based signature for a config-referenced file (or None)."""
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=256)
+def _is_executable_file(path, signature):
+    """os.access(path, X_OK), re-checked only when signature changes.
+
+    signature is _path_signature(path); mode/owner are part of it, so a
+    chmod or chown invalidates the cached answer.
+    """
+    return os.access(path, os.X_OK)
+
+
+def _config_path_signatures(config):
+    """Stat every engine and TLS file config references, once per path.
+
+    Returns {path: _path_signature(path)}; engines sharing a binary share
+    one stat. Non-string paths are left out (validation reports them).
+    """
+    paths = []
+    engines = config.get("engines")
+    if isinstance(engines, dict):
+        paths.extend(d["path"] for d in engines.values()
+                     if isinstance(d, dict) and d.get("path"))
+    if config.get("enable_tls", False):
+        paths.extend(config.get(k) or "" for k in ("tls_cert_path", "tls_key_path"))
+    signatures = {}
+    for p in paths:
+        if isinstance(p, str) and p not in signatures:
+            signatures[p] = _path_signature(p)
+    return signatures
+
+
+def _apply_config_defaults(config):
+    """Fill in OPTIONAL_CONFIG_DEFAULTS for keys missing from config."""
+    if OPTIONAL_CONFIG_DEFAULTS.keys() <= config.keys():
+        return
+    for key, default in _SHARED_DEFAULTS.items():
+        config.setdefault(key, default)
+    for key, default in _COPIED_DEFAULTS.items():
+        if key not in config:
+            config[key] = copy.deepcopy(default)
+
+
 def validate_config(config):
     """Validate config.json has required keys with correct types.
 
+    Optional keys missing from config are filled in with their defaults.
+    Each engine/TLS file referenced is stat'ed once.
+
     Returns list of error strings (empty if valid).
     """
+    signatures = _config_path_signatures(config)
     errors = []
 
+    def signature(path):
+        if isinstance(path, str) and path in signatures:
+            return signatures[path]
+        return _path_signature(path)
+
+    def is_file(path):
+        sig = signature(path)
+        return sig is not None and stat.S_ISREG(sig[0])
+
     for key, expected_type in REQUIRED_CONFIG_KEYS.items():
         if key not in config:
             errors.append(f"Missing required config key: '{key}'")
@@ -128,9 +241,7 @@ def validate_config(config):
             )
 
     # Apply defaults for optional keys
-    for key, default in OPTIONAL_CONFIG_DEFAULTS.items():
-        if key not in config:
-            config[key] = default
+    _apply_config_defaults(config)
 
     # Validate engines have required sub-keys
     engines = config.get("engines", {})
@@ -144,9 +255,10 @@ def validate_config(config):
                 errors.append(f"Engine '{name}' missing required key 'path'")
             else:
                 path = details["path"]
-                if path and not os.path.isfile(path):
+                # One stat answers existence; access() is cached per signature
+                if path and not is_file(path):
                     errors.append(f"Engine '{name}' path does not exist: '{path}'")
-                elif path and not os.access(path, os.X_OK):
+                elif path and not _is_executable_file(path, signature(path)):
                     errors.append(f"Engine '{name}' path is not executable: '{path}'")
             if "port" not in details:
                 errors.append(f"Engine '{name}' missing required key 'port'")
@@ -189,11 +301,11 @@ def validate_config(config):
         key_path = config.get("tls_key_path", "")
         if not cert_path:
             errors.append("enable_tls is true but tls_cert_path is empty")
-        elif not os.path.isfile(cert_path):
+        elif not is_file(cert_path):
             errors.append(f"TLS certificate not found: '{cert_path}'")
         if not key_path:
             errors.append("enable_tls is true but tls_key_path is empty")
-        elif not os.path.isfile(key_path):
+        elif not is_file(key_path):
             errors.append(f"TLS key not found: '{key_path}'")
 
     # Validate server_secret if explicitly set
@@ -212,11 +324,27 @@ def validate_config(config):
     return errors
 
 
+# Parsed config.json contents keyed by (abspath, st_mtime_ns, st_size)
+_CONFIG_CACHE = {}
+
+
 def load_config(path="config.json"):
-    """Load and validate configuration from JSON file."""
+    """Load and validate configuration from JSON file.
+
+    The parsed JSON is cached until the file's mtime or size changes; each
+    call still gets its own deep copy and is re-validated (validate_config
+    is memoized, so that is cheap for an unchanged config).
+    """
     try:
-        with open(path) as f:
-            config = json.load(f)
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        cached = _CONFIG_CACHE.get(key)
+        if cached is None:
+            with open(path, "rb") as f:
+                cached = _json_loads(f.read())
+            _CONFIG_CACHE.clear()  # the server only ever loads one config file
+            _CONFIG_CACHE[key] = cached
+        config = copy.deepcopy(cached)
     except FileNotFoundError:
         print(f"ERROR: Config file not found: {path}")
         print("Create a config.json file (see example_config.json for reference)")
@@ -235,6 +363,9 @@ def load_config(path="config.json"):
     return config
 
 
+load_config.cache_clear = _CONFIG_CACHE.clear
+
+
 # ---------------------------------------------------------------------------
 # Deferred config loading - initialized by _init_from_config() before server
 # starts, so CLI commands like --setup don't need a pre-existing config.json.
@@ -326,6 +457,10 @@ class FirewallBackend:
         pass
 
 
+# Parses "RemoteIP: ..." lines out of `netsh advfirewall firewall show rule`
+_NETSH_REMOTE_IP_RE = re.compile(r"RemoteIP:\s*(.*)")
+
+
 class WindowsFirewall(FirewallBackend):
     """Windows firewall backend using netsh (async subprocess)."""
 
@@ -353,7 +488,7 @@ class WindowsFirewall(FirewallBackend):
         )
 
         if rc == 0:
-            existing_ips = re.findall(r"RemoteIP:\s*(.*)", stdout)
+            existing_ips = _NETSH_REMOTE_IP_RE.findall(stdout)
             if existing_ips:
                 existing_ips = existing_ips[0].split(",")
                 if ip_address in existing_ips:
@@ -392,7 +527,7 @@ class WindowsFirewall(FirewallBackend):
         )
 
         if rc == 0:
-            existing = re.findall(r"RemoteIP:\s*(.*)", stdout)
+            existing = _NETSH_REMOTE_IP_RE.findall(stdout)
             if existing:
                 existing = existing[0].split(",")
                 if subnet in existing:
@@ -426,7 +561,7 @@ class WindowsFirewall(FirewallBackend):
             ["advfirewall", "firewall", "show", "rule", "name=Chess-Block-IPs"]
         )
         if rc == 0:
-            existing = re.findall(r"RemoteIP:\s*(.*)", stdout)
+            existing = _NETSH_REMOTE_IP_RE.findall(stdout)
             if existing:
                 existing = existing[0].split(",")
                 updated = [ip for ip in existing if ip not in trusted_ips]
@@ -441,7 +576,7 @@ class WindowsFirewall(FirewallBackend):
             ["advfirewall", "firewall", "show", "rule", "name=Chess-Block-Other"]
         )
         if rc == 0:
-            existing = re.findall(r"RemoteIP:\s*(.*)", stdout)
+            existing = _NETSH_REMOTE_IP_RE.findall(stdout)
             if existing:
                 existing = existing[0].split(",")
                 updated = [
@@ -468,6 +603,10 @@ class WindowsFirewall(FirewallBackend):
         ip_avoid = config["trusted_sources"]
         subnet_avoid = config["trusted_subnets"]
 
+        # Imported here: pulls in multiprocessing, which only the Windows
+        # subnet-blocking path needs
+        from concurrent.futures import ProcessPoolExecutor
+
         loop = asyncio.get_running_loop()
         with ProcessPoolExecutor() as pool:
             subnets_to_block = await loop.run_in_executor(
@@ -630,9 +769,13 @@ def build_engine_registry(cfg):
     Explicit engines from config take precedence. Auto-discovered engines
     from engine_directory are added with ports starting after the highest
     explicit port.
+
+    ALL_ENGINES is refilled in place, so references to it stay current
+    across rebuilds.
     """
-    global ALL_ENGINES
-    ALL_ENGINES = dict(cfg.get("engines", {}))
+    explicit = dict(cfg.get("engines", {}))
+    ALL_ENGINES.clear()
+    ALL_ENGINES.update(explicit)
 
     engine_dir = cfg.get("engine_directory", "")
     if engine_dir:
@@ -665,44 +808,53 @@ def build_engine_registry(cfg):
 # ---------------------------------------------------------------------------
 
 
-def find_available_port(host, preferred_port, max_attempts=100, exclude=None):
-    """Find an available TCP port starting from preferred_port.
+def find_available_port(host, preferred_port, max_attempts=2, exclude=None):
+    """Find an available TCP port, preferring preferred_port.
 
-    Skips ports in the exclude set. Returns the available port.
-    Raises OSError if no port found within max_attempts.
+    If preferred_port is taken or excluded, the kernel assigns a free port
+    (bind to port 0) instead of probing upward one bind() at a time. Ports
+    in the exclude set are never returned; a kernel pick that lands in it
+    is retried, up to max_attempts picks in total.
+    Raises OSError if no port is found.
     """
     if exclude is None:
         exclude = set()
-    for offset in range(max_attempts):
-        port = preferred_port + offset
-        if port in exclude:
-            continue
+    if preferred_port not in exclude:
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind((host, port))
-                return port
+                s.bind((host, preferred_port))
+                return preferred_port
         except OSError:
-            continue
+            pass
+    for _ in range(max_attempts):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((host, 0))
+            port = s.getsockname()[1]
+        if port not in exclude:
+            return port
     raise OSError(
-        f"No available port found in range "
-        f"{preferred_port}-{preferred_port + max_attempts - 1}"
+        f"No available port found for {host} "
+        f"(preferred {preferred_port}, {max_attempts} kernel-assigned tries)"
     )
 
 
 def resolve_ports(host, config):
-    """Resolve configured ports to available ones. Updates config and ALL_ENGINES in-place."""
-    claimed = set()
+    """Resolve configured ports to available ones. Updates config and ALL_ENGINES in-place.
+
+    Per-engine mode makes one pass in name order; each resolved port goes
+    into a claimed set so later engines never reuse it.
+    """
     single_port = config.get("enable_single_port", False)
 
     if single_port:
         preferred = config.get("base_port", 9998)
-        actual = find_available_port(host, preferred, exclude=claimed)
+        actual = find_available_port(host, preferred)
         if actual != preferred:
             logging.info(f"Port {preferred} in use, using port {actual}")
         config["base_port"] = actual
-        claimed.add(actual)
     else:
+        claimed = set()
         for name in sorted(ALL_ENGINES.keys()):
             details = ALL_ENGINES[name]
             if not isinstance(details, dict) or "port" not in details:
@@ -726,10 +878,19 @@ def _prepare_engine_registry():
 # ---------------------------------------------------------------------------
 
 
+# Discovered gateway, reused across mappings: {"upnp": UPnP, "external_ip": str}.
+# Empty until a discovery succeeds; cleared when mapping stops working.
+_UPNP_IGD = {}
+_UPNP_LOCK = threading.Lock()
+
+
 def _upnp_map_sync(internal_port, internal_ip, description, lease_duration):
     """Synchronous UPnP port mapping using miniupnpc.
 
-    Tries the requested port first, then internal_port + 10000 as fallback.
+    Tries the requested port first, then internal_port + 10000 as fallback
+    (skipped when that exceeds 65535, e.g. for a kernel-assigned port).
+    SSDP discovery (~2s) runs once and its IGD is reused for later mappings
+    and renewals; a failed mapping drops it so the next call re-discovers.
     Returns (external_ip, external_port) or (None, None).
     """
     try:
@@ -739,37 +900,46 @@ def _upnp_map_sync(internal_port, internal_ip, description, lease_duration):
                      "Install with: pip install miniupnpc")
         return None, None
 
-    u = miniupnpc.UPnP()
-    u.discoverdelay = 2000
-    try:
-        devices = u.discover()
-        if devices == 0:
-            logging.warning("UPnP: No IGD devices found")
-            return None, None
-
-        u.selectigd()
-        external_ip = u.externalipaddress()
-
-        # Try mapping the same external port first
-        for ext_port in [internal_port, internal_port + 10000]:
-            try:
-                result = u.addportmapping(
-                    ext_port, 'TCP', internal_ip, internal_port,
-                    description, '', lease_duration
-                )
-                if result:
-                    logging.info(f"UPnP: Mapped {internal_ip}:{internal_port} -> "
-                                 f"{external_ip}:{ext_port} (lease {lease_duration}s)")
-                    return external_ip, ext_port
-            except Exception as e:
-                logging.debug(f"UPnP: Port {ext_port} mapping failed: {e}")
-                continue
+    with _UPNP_LOCK:
+        try:
+            if not _UPNP_IGD:
+                u = miniupnpc.UPnP()
+                u.discoverdelay = 2000
+                devices = u.discover()
+                if devices == 0:
+                    logging.warning("UPnP: No IGD devices found")
+                    return None, None
+
+                u.selectigd()
+                _UPNP_IGD.update(upnp=u, external_ip=u.externalipaddress())
+            u = _UPNP_IGD["upnp"]
+            external_ip = _UPNP_IGD["external_ip"]
+
+            # Try mapping the same external port first
+            ext_ports = [internal_port]
+            if internal_port + 10000 <= 65535:
+                ext_ports.append(internal_port + 10000)
+            for ext_port in ext_ports:
+                try:
+                    result = u.addportmapping(
+                        ext_port, 'TCP', internal_ip, internal_port,
+                        description, '', lease_duration
+                    )
+                    if result:
+                        logging.info(f"UPnP: Mapped {internal_ip}:{internal_port} -> "
+                                     f"{external_ip}:{ext_port} (lease {lease_duration}s)")
+                        return external_ip, ext_port
+                except Exception as e:
+                    logging.debug(f"UPnP: Port {ext_port} mapping failed: {e}")
+                    continue
 
-        logging.warning(f"UPnP: Could not map port {internal_port}")
-        return None, None
-    except Exception as e:
-        logging.warning(f"UPnP: Discovery/mapping error: {e}")
-        return None, None
+            logging.warning(f"UPnP: Could not map port {internal_port}")
+            _UPNP_IGD.clear()
+            return None, None
+        except Exception as e:
+            logging.warning(f"UPnP: Discovery/mapping error: {e}")
+            _UPNP_IGD.clear()
+            return None, None
 
 
 async def try_upnp_mapping(internal_port, internal_ip, description, lease_duration):
@@ -877,17 +1047,30 @@ def generate_subnets_to_avoid(ip_addresses_to_avoid, subnets_to_avoid):
 # ---------------------------------------------------------------------------
 
 
-async def heartbeat(writer, engine_process, interval):
+async def heartbeat(writer, engine_process, interval, activity=None):
     """Send periodic isready keepalive to engine (valid UCI command).
 
     Unlike the previous \\nping\\n approach, isready is a standard UCI
     command that every UCI engine must respond to with readyok.
     The readyok response is forwarded to the client naturally through
     the engine response handler.
+
+    activity, if given, is a dict whose "last" key holds the time.monotonic()
+    timestamp of the engine's most recent output. While the engine has
+    produced output within the last interval the connection is evidently
+    alive, so the heartbeat is skipped and the next check is deferred until
+    interval seconds after that output.
     """
+    wait = interval
     while True:
         try:
-            await asyncio.sleep(interval)
+            await asyncio.sleep(wait)
+            if activity is not None:
+                idle = time.monotonic() - activity["last"]
+                if idle < interval:
+                    wait = interval - idle
+                    continue
+            wait = interval
             # Send isready to engine - a valid UCI keepalive
             engine_process.stdin.write(b"isready\n")
             await engine_process.stdin.drain()
@@ -913,18 +1096,57 @@ async def watchdog_timer(interval):
 # ---------------------------------------------------------------------------
 
 
+@functools.lru_cache(maxsize=8)
+def _trusted_subnet_index(subnets):
+    """Collapse trusted subnets into sorted, disjoint integer ranges.
+
+    subnets: tuple of CIDR strings. Returns {version: (starts, ends)} where
+    starts/ends are the first/last address of each range as ints, so a
+    single bisect finds the only range that could contain an address.
+    Invalid entries are skipped (validate_config reports them).
+    """
+    by_version = {4: [], 6: []}
+    for subnet in subnets:
+        try:
+            net = ipaddress.ip_network(subnet, strict=False)
+        except ValueError:
+            continue
+        by_version[net.version].append(net)
+
+    index = {}
+    for version, nets in by_version.items():
+        collapsed = list(ipaddress.collapse_addresses(nets))
+        index[version] = (
+            [int(n.network_address) for n in collapsed],
+            [int(n.broadcast_address) for n in collapsed],
+        )
+    return index
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_ip(ip):
+    """Return (version, int) for an IP string (cached per client IP)."""
+    addr = ipaddress.ip_address(ip)
+    return addr.version, int(addr)
+
+
 def is_trusted(client_ip, config):
     """Check if an IP is trusted (static config or auto-trusted)."""
-    if client_ip in config["trusted_sources"]:
-        return True
+    # auto_trusted_ips is a set: check it before scanning the config list
     if client_ip in auto_trusted_ips:
         return True
-    if any(
-        ipaddress.ip_address(client_ip) in ipaddress.ip_network(subnet, strict=False)
-        for subnet in config["trusted_subnets"]
-    ):
+    if client_ip in config["trusted_sources"]:
         return True
-    return False
+    if not config["trusted_subnets"]:
+        return False
+    try:
+        version, ip_int = _parse_ip(client_ip)
+    except ValueError:
+        # e.g. "unknown" when the peer address is unavailable
+        return False
+    starts, ends = _trusted_subnet_index(tuple(config["trusted_subnets"]))[version]
+    i = bisect.bisect_right(starts, ip_int) - 1
+    return i >= 0 and ip_int <= ends[i]
 
 
 async def check_connection_attempts(client_ip, config, firewall):
@@ -1023,12 +1245,19 @@ async def handle_auto_trust(client_ip, config):
 # ---------------------------------------------------------------------------
 
 
+# SSL contexts keyed by (cert_path, key_path) plus both files' stat info
+_SSL_CONTEXTS = {}
+
+
 def create_ssl_context(config):
     """Create an SSL context for TLS-encrypted connections.
 
     Returns an ssl.SSLContext if TLS is enabled and configured, else None.
     Supports self-signed certificates (clients must trust the CA or disable
     verification on their end).
+
+    Contexts are cached until the cert or key file changes on disk; a
+    failed load returns None and is not cached.
     """
     if not config.get("enable_tls", False):
         return None
@@ -1036,6 +1265,17 @@ def create_ssl_context(config):
     cert_path = config["tls_cert_path"]
     key_path = config["tls_key_path"]
 
+    try:
+        cert_st = os.stat(cert_path)
+        key_st = os.stat(key_path)
+        cache_key = (cert_path, cert_st.st_mtime_ns, cert_st.st_size,
+                     key_path, key_st.st_mtime_ns, key_st.st_size)
+    except OSError:
+        cache_key = None  # let load_cert_chain report the error
+    ctx = _SSL_CONTEXTS.get(cache_key)
+    if ctx is not None:
+        return ctx
+
     ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ctx.minimum_version = ssl.TLSVersion.TLSv1_2
     try:
@@ -1046,14 +1286,31 @@ def create_ssl_context(config):
         return None
 
     logging.info("TLS enabled with cert: %s", cert_path)
+    if cache_key is not None:
+        _SSL_CONTEXTS.clear()  # only the current cert/key pair is useful
+        _SSL_CONTEXTS[cache_key] = ctx
     return ctx
 
 
+create_ssl_context.cache_clear = _SSL_CONTEXTS.clear
+
+
 # ---------------------------------------------------------------------------
 # Token authentication
 # ---------------------------------------------------------------------------
 
 
+if hasattr(asyncio, "timeout"):
+    async def _readline_within(reader, timeout):
+        """readline() with a deadline, without wrapping it in a Task."""
+        async with asyncio.timeout(timeout):
+            return await reader.readline()
+else:  # Python < 3.11
+    async def _readline_within(reader, timeout):
+        """readline() with a deadline."""
+        return await asyncio.wait_for(reader.readline(), timeout=timeout)
+
+
 async def authenticate_client(reader, writer, config):
     """Perform token-based authentication handshake.
 
@@ -1072,12 +1329,15 @@ async def authenticate_client(reader, writer, config):
         writer.write(b"AUTH_REQUIRED\n")
         await writer.drain()
 
-        data = await asyncio.wait_for(reader.readline(), timeout=10)
+        data = await _readline_within(reader, 10)
         if not data:
             return False
 
-        client_msg = data.decode().strip()
-        if client_msg.startswith("AUTH ") and client_msg[5:] == token:
+        # Parse on bytes; no decode needed to check the prefix and token
+        client_msg = data.strip()
+        # Constant-time compare so response timing doesn't leak the token
+        if client_msg.startswith(b"AUTH ") and hmac.compare_digest(
+                client_msg[5:], token.encode()):
             writer.write(b"AUTH_OK\n")
             await writer.drain()
             return True
@@ -1098,6 +1358,19 @@ async def authenticate_client(reader, writer, config):
 # ---------------------------------------------------------------------------
 
 
+class EngineSession:
+    """A (possibly warm) engine process tracked by SessionManager."""
+
+    __slots__ = ("process", "expiry_handle", "last_position")
+
+    def __init__(self, process: asyncio.subprocess.Process,
+                 expiry_handle: Optional[asyncio.TimerHandle] = None,
+                 last_position: Optional[str] = None):
+        self.process = process
+        self.expiry_handle = expiry_handle
+        self.last_position = last_position
+
+
 class SessionManager:
     """Manages engine process sessions across client disconnects.
 
@@ -1107,18 +1380,19 @@ class SessionManager:
     """
 
     def __init__(self):
-        self._sessions = {}  # engine_name -> {process, expiry_task, last_position}
+        self._sessions = {}  # engine_name -> EngineSession
         self._lock = asyncio.Lock()
+        self._expiring = set()  # strong refs to in-flight expiry tasks
 
     async def get_or_create(self, engine_name, engine_path, config):
         """Get an existing warm session or create a new engine process."""
         async with self._lock:
-            if engine_name in self._sessions:
-                session = self._sessions[engine_name]
-                if session["expiry_task"] is not None:
-                    session["expiry_task"].cancel()
-                    session["expiry_task"] = None
-                proc = session["process"]
+            session = self._sessions.get(engine_name)
+            if session is not None:
+                if session.expiry_handle is not None:
+                    session.expiry_handle.cancel()
+                    session.expiry_handle = None
+                proc = session.process
                 if proc.returncode is None:  # Still alive
                     logging.info(f"Reattaching to warm engine session: {engine_name}")
                     return proc, True  # True = reattached
@@ -1135,11 +1409,7 @@ class SessionManager:
             cwd=engine_dir,
         )
         async with self._lock:
-            self._sessions[engine_name] = {
-                "process": proc,
-                "expiry_task": None,
-                "last_position": None,
-            }
+            self._sessions[engine_name] = EngineSession(proc)
         return proc, False
 
     async def release(self, engine_name, config):
@@ -1150,32 +1420,60 @@ class SessionManager:
             return
 
         async with self._lock:
-            if engine_name not in self._sessions:
+            session = self._sessions.get(engine_name)
+            if session is None:
                 return
-            session = self._sessions[engine_name]
             logging.info(
                 f"Engine {engine_name} released. Keeping alive for {keepalive}s"
             )
-            session["expiry_task"] = asyncio.create_task(
-                self._expire_session(engine_name, keepalive)
+            # A plain timer is enough here; no coroutine is kept alive
+            # for the whole keepalive period. Cancelling any earlier timer
+            # keeps expiry_handle the only one that can fire.
+            if session.expiry_handle is not None:
+                session.expiry_handle.cancel()
+            session.expiry_handle = asyncio.get_running_loop().call_later(
+                keepalive, self._on_keepalive_expired, engine_name, session
             )
 
-    async def _expire_session(self, engine_name, timeout):
-        """Terminate engine after timeout if no client reattaches."""
-        await asyncio.sleep(timeout)
+    def _on_keepalive_expired(self, engine_name, session):
+        """Timer callback: start terminating the expired session."""
+        # Only the live timer fires, so this is the handle that expired
+        task = asyncio.ensure_future(
+            self._expire_session(engine_name, session, session.expiry_handle))
+        self._expiring.add(task)
+        task.add_done_callback(self._expiring.discard)
+
+    async def _expire_session(self, engine_name, session, handle):
+        """Terminate engine after timeout if no client reattached meanwhile."""
+        async with self._lock:
+            # A reattach clears expiry_handle and a later release replaces
+            # it; a restart replaces the session
+            if (self._sessions.get(engine_name) is not session
+                    or session.expiry_handle is not handle):
+                return
+            del self._sessions[engine_name]
         logging.info(f"Session keepalive expired for {engine_name}")
-        await self._terminate(engine_name)
+        await self._stop_process(session)
 
     async def _terminate(self, engine_name):
         """Terminate an engine process and remove from sessions."""
         async with self._lock:
             session = self._sessions.pop(engine_name, None)
-        if session and session["process"].returncode is None:
+        if session:
+            if session.expiry_handle is not None:
+                session.expiry_handle.cancel()
+            await self._stop_process(session)
+
+    @staticmethod
+    async def _stop_process(session):
+        """Ask the engine to quit, then terminate it."""
+        if session.process.returncode is None:
+            proc = session.process
             try:
-                session["process"].stdin.write(b"quit\n")
-                await session["process"].stdin.drain()
-                session["process"].terminate()
-                await session["process"].wait()
+                proc.stdin.write(b"quit\n")
+                await proc.stdin.drain()
+                proc.terminate()
+                await proc.wait()
             except (ProcessLookupError, BrokenPipeError, OSError):
                 pass
 
@@ -1206,33 +1504,50 @@ class OutputThrottler:
 
     def __init__(self, throttle_ms):
         self.throttle_ms = throttle_ms
-        self.last_send_time = 0
-        self.last_depth = None
+        # Integer monotonic nanoseconds: no float math per line, and immune
+        # to wall-clock jumps. Start one window back so the first line passes.
+        self._throttle_ns = int(throttle_ms * 1_000_000)
+        self._last_send_ns = -self._throttle_ns
+        self.last_depth = -1  # no info line seen yet; real depths are >= 0
         self.pending_info = None
+        # Leading bytes of the last line, through "depth N ". Any line that
+        # starts with them carries the same depth, so parsing is skipped.
+        self._depth_prefix = None
 
     def should_forward(self, line):
-        """Returns True if this line should be forwarded to the client."""
+        """Returns True if this line should be forwarded to the client.
+
+        line is normally the raw bytes read from the engine, so no decode
+        is needed to classify it; str is accepted too.
+        """
         if self.throttle_ms <= 0:
             return True
+        if isinstance(line, str):
+            line = line.encode()
 
-        # Always forward non-info lines immediately
-        if not line.startswith("info "):
+        # Always forward non-info lines immediately, before any parsing
+        if not line.startswith(b"info "):
             # Flush any pending info before non-info lines
             self.pending_info = None
             return True
 
-        # Check if depth changed
-        current_depth = self._extract_depth(line)
-        if current_depth is not None and current_depth != self.last_depth:
-            self.last_depth = current_depth
-            self.last_send_time = time.time() * 1000
-            self.pending_info = None
-            return True
+        # Check if depth changed (consecutive lines of one iteration share
+        # their "info depth N " prefix, so most lines skip the split)
+        prefix = self._depth_prefix
+        if prefix is None or not line.startswith(prefix):
+            current_depth = self._extract_depth(line)
+            if current_depth is not None:
+                self._depth_prefix = self._prefix_through_depth(line)
+                if current_depth != self.last_depth:
+                    self.last_depth = current_depth
+                    self._last_send_ns = time.monotonic_ns()
+                    self.pending_info = None
+                    return True
 
         # Time-based throttle
-        now = time.time() * 1000
-        if now - self.last_send_time >= self.throttle_ms:
-            self.last_send_time = now
+        now = time.monotonic_ns()
+        if now - self._last_send_ns >= self._throttle_ns:
+            self._last_send_ns = now
             self.pending_info = None
             return True
 
@@ -1240,16 +1555,84 @@ class OutputThrottler:
         self.pending_info = line
         return False
 
+    @staticmethod
+    def _prefix_through_depth(line):
+        """Return line up to and including "depth N ", or None.
+
+        The prefix ends after the whitespace following a depth value, so it
+        always contains the first depth token and its complete value.
+        """
+        i = line.find(b" depth ")
+        if i < 0:
+            return None
+        end = line.find(b" ", i + 7)
+        if end <= i + 7:
+            return None
+        return line[:end + 1]
+
     def _extract_depth(self, line):
-        """Extract 'depth N' value from UCI info string."""
-        parts = line.split()
-        for i, part in enumerate(parts):
-            if part == "depth" and i + 1 < len(parts):
-                try:
-                    return int(parts[i + 1])
-                except ValueError:
-                    pass
-        return None
+        """Extract 'depth N' value from UCI info string.
+
+        Engines put depth near the front ("info depth 20 seldepth 31 ..."),
+        so only the leading tokens are split off; the whole line is scanned
+        only when it is long and depth wasn't among them.
+        Works on bytes (int() parses ASCII digits directly) or str.
+        """
+        if isinstance(line, str):
+            line = line.encode()
+        parts = line.split(None, 6)
+        try:
+            i = parts.index(b"depth", 0, 5)
+        except ValueError:
+            if len(parts) < 7:
+                return None
+            parts = line.split()
+            try:
+                i = parts.index(b"depth")
+            except ValueError:
+                return None
+        try:
+            return int(parts[i + 1])
+        except (IndexError, ValueError):
+            return None
+
+
+# ---------------------------------------------------------------------------
+# UCI option overrides
+# ---------------------------------------------------------------------------
+
+_SETOPTION_PREFIX = "setoption name "
+
+
+def _apply_override(command, engine_customs, global_customs):
+    """Apply server-side custom_variables to a client setoption command.
+
+    Priority:
+    1. Per-engine custom_variables with value "override" -> pass through client value
+    2. Per-engine custom_variables with specific value -> substitute server value
+    3. Global custom_variables with specific value -> substitute server value
+    4. Otherwise -> pass through client value
+
+    Option names may contain spaces ("Skill Level"); the name is everything
+    between "setoption name " and the first " value ".
+    Returns the command to send to the engine.
+    """
+    if not (engine_customs or global_customs):
+        return command  # nothing configured: the common case
+    if not command.startswith(_SETOPTION_PREFIX):
+        return command
+    opt_name, sep, _ = command[len(_SETOPTION_PREFIX):].partition(" value ")
+    if not sep:
+        return command
+
+    server_value = engine_customs.get(opt_name)
+    if server_value is None:
+        server_value = global_customs.get(opt_name)
+    elif server_value == "override":
+        return command
+    if server_value is None:
+        return command
+    return f"setoption name {opt_name} value {server_value}"
 
 
 # ---------------------------------------------------------------------------
@@ -1257,11 +1640,20 @@ class OutputThrottler:
 # ---------------------------------------------------------------------------
 
 
-async def client_handler(reader, writer, engine_path, log_file, engine_name,
-                         config, firewall):
-    """Handle a single client connection."""
+def _peer_ip(writer):
+    """Return the connected peer's IP address, or "unknown"."""
     peername = writer.get_extra_info('peername')
-    client_ip = peername[0] if peername else "unknown"
+    return peername[0] if peername else "unknown"
+
+
+async def client_handler(reader, writer, engine_path, log_file, engine_name,
+                         config, firewall, client_ip=None):
+    """Handle a single client connection.
+
+    client_ip may be passed by callers that already looked up the peer.
+    """
+    if client_ip is None:
+        client_ip = _peer_ip(writer)
     logging.info(f"Connection opened from {client_ip}")
 
     # Trust check (with auto-trust support)
@@ -1326,14 +1718,17 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name,
                     cwd=engine_dir,
                 )
 
-            # Start heartbeat (sends isready to engine, not ping to client)
+            # Start heartbeat (sends isready to engine, not ping to client);
+            # suppressed while the engine is producing output
+            engine_activity = {"last": time.monotonic()}
             heartbeat_task = asyncio.create_task(
-                heartbeat(writer, engine_process, heartbeat_interval)
+                heartbeat(writer, engine_process, heartbeat_interval, engine_activity)
             )
 
             # Output throttler
             throttle_ms = config.get("info_throttle_ms", 0)
             throttler = OutputThrottler(throttle_ms)
+            throttling = throttle_ms > 0
 
             async def process_command(command):
                 """Send a command to the engine process."""
@@ -1393,6 +1788,9 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name,
                 writer.close()
                 return
 
+            engine_customs = ALL_ENGINES.get(engine_name, {}).get("custom_variables", {})
+            has_overrides = bool(engine_customs or CUSTOM_VARIABLES)
+
             async def process_client_commands():
                 nonlocal last_activity_time
                 while True:
@@ -1410,28 +1808,12 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name,
                             if not command:
                                 continue
 
-                            if command.startswith('setoption name'):
-                                parts = command.split(' ')
-                                if len(parts) >= 5 and parts[1] == 'name' and parts[3] == 'value':
-                                    opt_name = parts[2]
-                                    opt_value = ' '.join(parts[4:])
-                                    engine_customs = ALL_ENGINES.get(engine_name, {}).get("custom_variables", {})
-
-                                    if opt_name in engine_customs:
-                                        if engine_customs[opt_name] == "override":
-                                            await process_command(command)
-                                        else:
-                                            modified = f"setoption name {opt_name} value {engine_customs[opt_name]}"
-                                            await process_command(modified)
-                                    elif opt_name in CUSTOM_VARIABLES:
-                                        modified = f"setoption name {opt_name} value {CUSTOM_VARIABLES[opt_name]}"
-                                        await process_command(modified)
-                                    else:
-                                        await process_command(command)
-                                else:
-                                    await process_command(command)
-                            else:
-                                await process_command(command)
+                            # Only setoption can be rewritten; skip the call
+                            # for position/go/stop and other hot commands
+                            if has_overrides and command.startswith(_SETOPTION_PREFIX):
+                                command = _apply_override(
+                                    command, engine_customs, CUSTOM_VARIABLES)
+                            await process_command(command)
 
                     except asyncio.TimeoutError:
                         continue  # Timeout is normal, keep waiting
@@ -1450,16 +1832,20 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name,
                         )
                         if not data:
                             break
-                        decoded = data.decode().strip()
-                        # Apply output throttling
-                        if throttler.should_forward(decoded):
+                        engine_activity["last"] = time.monotonic()
+                        # Apply output throttling (skipped when disabled);
+                        # the throttler reads the raw bytes
+                        if not throttling or throttler.should_forward(data.strip()):
                             writer.write(data)
                             await writer.drain()
-                        if config["enable_uci_log"]:
-                            with open(log_file, "a") as f:
-                                f.write(f"Engine: {decoded}\n")
-                        if config["detailed_log_verbosity"]:
-                            logging.debug(f"Engine -> Client: {decoded}")
+                        # Only decode when something will log the line
+                        if config["enable_uci_log"] or config["detailed_log_verbosity"]:
+                            decoded = data.decode(errors="replace").strip()
+                            if config["enable_uci_log"]:
+                                with open(log_file, "a") as f:
+                                    f.write(f"Engine: {decoded}\n")
+                            if config["detailed_log_verbosity"]:
+                                logging.debug(f"Engine -> Client: {decoded}")
                     except asyncio.TimeoutError:
                         continue  # Timeout is normal for engine responses
                     except ConnectionResetError:
@@ -1553,8 +1939,7 @@ async def multiplex_handler(reader, writer, config, firewall, ssl_ctx=None):
 
     Then delegates to client_handler() with the resolved engine.
     """
-    peername = writer.get_extra_info('peername')
-    client_ip = peername[0] if peername else "unknown"
+    client_ip = _peer_ip(writer)
 
     # Trust check
     if config.get("enable_trusted_sources", False):
@@ -1594,10 +1979,9 @@ async def multiplex_handler(reader, writer, config, firewall, ssl_ctx=None):
         engine_name = next(iter(ALL_ENGINES))
 
     if first_line == "ENGINE_LIST":
-        # Send sorted engine list
-        for name in sorted(ALL_ENGINES.keys()):
-            writer.write(f"ENGINE {name}\n".encode())
-        writer.write(b"ENGINES_END\n")
+        # Send sorted engine list as a single write
+        listing = "".join(f"ENGINE {name}\n" for name in sorted(ALL_ENGINES))
+        writer.write(f"{listing}ENGINES_END\n".encode())
         await writer.drain()
 
         # Wait for SELECT_ENGINE
@@ -1653,7 +2037,7 @@ async def multiplex_handler(reader, writer, config, firewall, ssl_ctx=None):
     inner_config["auth_method"] = "none"
 
     await client_handler(reader, writer, details["path"], log_file,
-                         engine_name, inner_config, firewall)
+                         engine_name, inner_config, firewall, client_ip=client_ip)
 
 
 async def start_multiplex_server(host, port, config, firewall, ssl_ctx=None):
@@ -1959,8 +2343,7 @@ async def main():
             relay_sessions["_server_multiplex"] = derive_session_id(
                 server_secret, "_server_multiplex")
         else:
-            for engine_name in ALL_ENGINES:
-                relay_sessions[engine_name] = derive_session_id(server_secret, engine_name)
+            relay_sessions.update(derive_session_ids(server_secret, ALL_ENGINES))
 
     # Generate connection file (always — LAN-only setups benefit too)
     generate_connection_file(config, upnp_results or None, relay_sessions or None)
@@ -2071,10 +2454,22 @@ async def main():
         logging.info(f"PID file {pid_path} removed")
 
 
+# Cert fingerprints keyed by (path, st_mtime_ns, st_size)
+_CERT_FINGERPRINTS = {}
+
+
 def get_cert_fingerprint(cert_path):
-    """Get SHA-256 fingerprint of a TLS certificate."""
-    import hashlib
+    """Get SHA-256 fingerprint of a TLS certificate.
+
+    Cached until the certificate file changes on disk. Returns "" (uncached)
+    if the file can't be read or parsed.
+    """
     try:
+        st = os.stat(cert_path)
+        key = (cert_path, st.st_mtime_ns, st.st_size)
+        cached = _CERT_FINGERPRINTS.get(key)
+        if cached is not None:
+            return cached
         with open(cert_path, "rb") as f:
             cert_data = f.read()
         # Parse PEM to DER
@@ -2083,22 +2478,44 @@ def get_cert_fingerprint(cert_path):
         der_lines = [l for l in lines if not l.startswith("-----")]
         der_data = base64.b64decode("".join(der_lines))
         digest = hashlib.sha256(der_data).hexdigest()
-        return ":".join(digest[i:i+2] for i in range(0, len(digest), 2))
+        fingerprint = ":".join(digest[i:i+2] for i in range(0, len(digest), 2))
     except Exception:
         return ""
+    _CERT_FINGERPRINTS[key] = fingerprint
+    return fingerprint
+
+
+get_cert_fingerprint.cache_clear = _CERT_FINGERPRINTS.clear
+
+_local_ip = None
 
 
 def get_local_ip():
-    """Get the machine's LAN IP address."""
-    import socket
+    """Get the machine's LAN IP address.
+
+    A successful lookup is cached for the process lifetime; the loopback
+    fallback is not, so a later call can pick up a network that came up.
+    """
+    global _local_ip
+    if _local_ip is not None:
+        return _local_ip
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
-        return ip
     except Exception:
         return "127.0.0.1"
+    _local_ip = ip
+    return ip
+
+
+def _clear_local_ip_cache():
+    global _local_ip
+    _local_ip = None
+
+
+get_local_ip.cache_clear = _clear_local_ip_cache
 
 
 def get_wan_ip():
@@ -2137,6 +2554,8 @@ def generate_pairing_qr(config, upnp_results=None, relay_sessions=None):
         "external_host": "<UPnP external IP>",
         "relay": {"host": "relay.example.com", "port": 19000}
     }
+
+    Returns the payload dict that was encoded.
     """
     try:
         import qrcode
@@ -2155,10 +2574,30 @@ def generate_pairing_qr(config, upnp_results=None, relay_sessions=None):
 
     host_ip = get_local_ip()
 
+    single_port = config.get("enable_single_port", False)
+    shared_port = config.get("base_port", 9998) if single_port else None
+
+    relay_url = config.get("relay_server_url", "")
+    use_relay = bool(relay_url and relay_sessions)
+    # Single-port: all engines share the same relay session
+    shared_session = (relay_sessions.get("_server_multiplex")
+                      if use_relay and single_port else None)
+
+    def engine_entry(name, details):
+        # In single-port mode, each engine's port is the shared port
+        entry = {"name": name,
+                 "port": shared_port if single_port else details["port"],
+                 "mdns_name": name}
+        if use_relay:
+            session = shared_session or relay_sessions.get(name)
+            if session is not None:
+                entry["relay_session"] = session
+        return entry
+
     # Use ALL_ENGINES (resolved ports) if available, fall back to config
     engines_source = ALL_ENGINES if ALL_ENGINES else config.get("engines", {})
     engines_list = [
-        {"name": name, "port": details["port"], "mdns_name": name}
+        engine_entry(name, details)
         for name, details in engines_source.items()
         if isinstance(details, dict) and "port" in details
     ]
@@ -2177,13 +2616,9 @@ def generate_pairing_qr(config, upnp_results=None, relay_sessions=None):
     }
 
     # Include single-port info when enabled
-    single_port = config.get("enable_single_port", False)
     if single_port:
         payload["single_port"] = True
-        payload["port"] = config.get("base_port", 9998)
-        # In single-port mode, override each engine's port with the shared port
-        for eng in engines_list:
-            eng["port"] = payload["port"]
+        payload["port"] = shared_port
 
     # Include PSK in payload when method is psk
     if auth_method == "psk" and config.get("psk_key", ""):
@@ -2208,25 +2643,14 @@ def generate_pairing_qr(config, upnp_results=None, relay_sessions=None):
         if wan_ip:
             payload["external_host"] = wan_ip
 
-    # Add relay info if configured
-    relay_url = config.get("relay_server_url", "")
-    if relay_url and relay_sessions:
+    # Add relay info if configured (per-engine session IDs are set above)
+    if use_relay:
         payload["relay"] = {
             "host": relay_url,
             "port": config.get("relay_server_port", 19000),
         }
-        # Add session IDs per engine
-        if single_port and "_server_multiplex" in relay_sessions:
-            # Single-port: all engines share the same relay session
-            shared_session = relay_sessions["_server_multiplex"]
-            for eng in engines_list:
-                eng["relay_session"] = shared_session
-        else:
-            for eng in engines_list:
-                if eng["name"] in relay_sessions:
-                    eng["relay_session"] = relay_sessions[eng["name"]]
 
-    payload_json = json.dumps(payload, separators=(",", ":"))
+    payload_json = _json_dumps(payload)
 
     print("\n" + "=" * 60)
     print("  Chess UCI Server - Pairing")
@@ -2267,15 +2691,20 @@ def generate_pairing_qr(config, upnp_results=None, relay_sessions=None):
     print(f"\n  Payload (for manual import / QR generation):")
     print(f"  {payload_json}")
     print("=" * 60 + "\n")
+    return payload
 
 
-def generate_connection_file(config, upnp_results=None, relay_sessions=None):
+def generate_connection_file(config, upnp_results=None, relay_sessions=None,
+                             out_fp=None):
     """Generate a .chessuci connection file for DroidFish import.
 
     The file contains all connection endpoints (LAN, UPnP, relay) and
     security config, enabling zero-config setup on the client.
     Supports both per-engine and single-port modes.
 
+    If out_fp (a text stream) is given, the JSON is written there instead
+    of to connection_file_path and None is returned.
+
     Returns the path of the written file.
     """
     from datetime import datetime, timezone
@@ -2376,6 +2805,10 @@ def generate_connection_file(config, upnp_results=None, relay_sessions=None):
         connection["port"] = base_port
         connection["available_engines"] = sorted(engines_source.keys())
 
+    if out_fp is not None:
+        json.dump(connection, out_fp, indent=2)
+        return None
+
     file_path = config.get("connection_file_path", "connection.chessuci")
     with open(file_path, "w") as f:
         json.dump(connection, f, indent=2)
@@ -2417,8 +2850,7 @@ async def _resolve_endpoints(cfg):
             relay["_server_multiplex"] = derive_session_id(
                 secret, "_server_multiplex")
         else:
-            for name in ALL_ENGINES:
-                relay[name] = derive_session_id(secret, name)
+            relay.update(derive_session_ids(secret, ALL_ENGINES))
 
     return upnp or None, relay or None
 
@@ -2428,6 +2860,27 @@ async def _resolve_endpoints(cfg):
 # ---------------------------------------------------------------------------
 
 
+def _mdns_each(func, infos):
+    """Call func(info) for every ServiceInfo, concurrently when there are several.
+
+    Zeroconf's blocking register/unregister calls each wait out their own
+    multicast announcements, so running them on threads overlaps that wait.
+    Returns a list with None or the raised exception per info, in order.
+    """
+    def call(info):
+        try:
+            func(info)
+        except Exception as e:
+            return e
+        return None
+
+    if len(infos) <= 1:
+        return [call(info) for info in infos]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(8, len(infos))) as pool:
+        return list(pool.map(call, infos))
+
+
 def start_mdns_advertisement(config):
     """Advertise engine servers via mDNS/Zeroconf (DNS-SD).
 
@@ -2460,35 +2913,35 @@ def start_mdns_advertisement(config):
 
     tls_enabled = config.get("enable_tls", False)
     auth_enabled = bool(config.get("auth_token", ""))
+    # DNS-SD service name: <instance>._chess-uci._tcp.local.
+    svc_type = "_chess-uci._tcp.local."
+    server = f"{socket.gethostname()}.local."
 
-    for engine_name, details in config["engines"].items():
-        port = details["port"]
-        # DNS-SD service name: <instance>._chess-uci._tcp.local.
-        svc_type = "_chess-uci._tcp.local."
-        svc_name = f"{engine_name}.{svc_type}"
-
-        properties = {
-            "engine": engine_name,
-            "tls": str(tls_enabled).lower(),
-            "auth": str(auth_enabled).lower(),
-        }
-
-        info = ServiceInfo(
+    infos = [
+        ServiceInfo(
             svc_type,
-            svc_name,
+            f"{engine_name}.{svc_type}",
             addresses=[packed_ip],
-            port=port,
-            properties=properties,
-            server=f"{socket.gethostname()}.local.",
+            port=details["port"],
+            properties={
+                "engine": engine_name,
+                "tls": str(tls_enabled).lower(),
+                "auth": str(auth_enabled).lower(),
+            },
+            server=server,
         )
-        try:
-            zc.register_service(info)
+        for engine_name, details in config["engines"].items()
+    ]
+    results = _mdns_each(zc.register_service, infos)
+    for engine_name, info, error in zip(config["engines"], infos, results):
+        if error is None:
             services.append(info)
             logging.info(
-                f"mDNS: Registered {engine_name} as {svc_name} on port {port}"
+                f"mDNS: Registered {engine_name} as {engine_name}.{svc_type} "
+                f"on port {info.port}"
             )
-        except Exception as e:
-            logging.error(f"mDNS: Failed to register {engine_name}: {e}")
+        else:
+            logging.error(f"mDNS: Failed to register {engine_name}: {error}")
 
     return zc, services
 
@@ -2549,11 +3002,7 @@ def stop_mdns_advertisement(zc, services):
     """Unregister all mDNS services and close Zeroconf."""
     if zc is None:
         return
-    for info in services:
-        try:
-            zc.unregister_service(info)
-        except Exception:
-            pass
+    _mdns_each(zc.unregister_service, services)
     zc.close()
     logging.info("mDNS: All services unregistered")
 
@@ -2563,29 +3012,34 @@ def stop_mdns_advertisement(zc, services):
 # ---------------------------------------------------------------------------
 
 
-def _is_engine_candidate(full_path, entry, skip_names, skip_extensions, is_windows):
-    """Check if a file looks like a chess engine executable."""
-    if not os.path.isfile(full_path):
-        return False
+def _is_engine_candidate(entry, skip_names, skip_extensions, is_windows):
+    """Check if a directory entry looks like a chess engine executable.
 
-    name_no_ext = os.path.splitext(entry)[0]
-    _, ext = os.path.splitext(entry)
+    entry is an os.DirEntry. Name checks run first since they are free;
+    is_file() uses the file type cached by scandir (no stat for regular
+    files), leaving at most one access() call per remaining candidate.
+    """
+    name_no_ext, ext = os.path.splitext(entry.name)
+    ext = ext.lower()
 
     # Skip known non-engine files
     if name_no_ext.lower() in skip_names:
         return False
-    if ext.lower() in skip_extensions:
+    if ext in skip_extensions:
         return False
 
     # Platform-specific executable check
     if is_windows:
-        if ext.lower() != ".exe":
-            return False
-    else:
-        if not os.access(full_path, os.X_OK):
+        if ext != ".exe":
             return False
+        return entry.is_file()
+    return entry.is_file() and os.access(entry.path, os.X_OK)
 
-    return True
+
+def _sorted_entries(directory):
+    """Return os.scandir entries of directory, sorted by name."""
+    with os.scandir(directory) as it:
+        return sorted(it, key=lambda e: e.name)
 
 
 def discover_engines(directory):
@@ -2619,28 +3073,41 @@ def discover_engines(directory):
 
     engines = []
     seen_names = set()
+    # Absolute base, so entry.path needs no per-file abspath()
+    top_entries = _sorted_entries(os.path.abspath(directory))
 
     # Scan top-level files
-    for entry in sorted(os.listdir(directory)):
-        full_path = os.path.join(directory, entry)
-        if _is_engine_candidate(full_path, entry, skip_names, skip_extensions, is_windows):
-            name_no_ext = os.path.splitext(entry)[0]
-            engines.append((name_no_ext, os.path.abspath(full_path)))
+    for entry in top_entries:
+        if _is_engine_candidate(entry, skip_names, skip_extensions, is_windows):
+            name_no_ext = os.path.splitext(entry.name)[0]
+            engines.append((name_no_ext, entry.path))
             seen_names.add(name_no_ext.lower())
 
     # Scan one level of subdirectories
-    for entry in sorted(os.listdir(directory)):
-        subdir = os.path.join(directory, entry)
-        if not os.path.isdir(subdir):
-            continue
-        for sub_entry in sorted(os.listdir(subdir)):
-            sub_path = os.path.join(subdir, sub_entry)
-            if _is_engine_candidate(sub_path, sub_entry, skip_names, skip_extensions, is_windows):
-                name_no_ext = os.path.splitext(sub_entry)[0]
-                # Skip if a top-level engine with the same name already found
-                if name_no_ext.lower() not in seen_names:
-                    engines.append((name_no_ext, os.path.abspath(sub_path)))
-                    seen_names.add(name_no_ext.lower())
+    def scan_subdir(path):
+        return [
+            sub_entry for sub_entry in _sorted_entries(path)
+            if _is_engine_candidate(sub_entry, skip_names, skip_extensions, is_windows)
+        ]
+
+    subdirs = [entry.path for entry in top_entries if entry.is_dir()]
+    if len(subdirs) <= 2:
+        found = map(scan_subdir, subdirs)
+    else:
+        # scandir/access release the GIL, so threads overlap the per-folder
+        # syscalls (noticeable on network-mounted engine trees). map() keeps
+        # folder order, so results are the same as a sequential scan.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(8, len(subdirs))) as pool:
+            found = list(pool.map(scan_subdir, subdirs))
+
+    for sub_entries in found:
+        for sub_entry in sub_entries:
+            name_no_ext = os.path.splitext(sub_entry.name)[0]
+            # Skip if a top-level engine with the same name already found
+            if name_no_ext.lower() not in seen_names:
+                engines.append((name_no_ext, sub_entry.path))
+                seen_names.add(name_no_ext.lower())
 
     return engines
 
@@ -2651,10 +3118,10 @@ def assign_ports(engine_list, base_port=9998):
     engine_list: list of (name, path) tuples
     Returns dict: {name: {"path": path, "port": port}}
     """
-    result = {}
-    for i, (name, path) in enumerate(engine_list):
-        result[name] = {"path": path, "port": base_port + i}
-    return result
+    return {
+        name: {"path": path, "port": port}
+        for port, (name, path) in enumerate(engine_list, start=base_port)
+    }
 
 
 def generate_auth_token(length=32):
@@ -2662,18 +3129,53 @@ def generate_auth_token(length=32):
     return secrets.token_hex(length)
 
 
-def generate_tls_certs(cert_dir="./certs"):
+# Reuse an existing cert only if it stays valid at least this long
+TLS_CERT_MIN_REMAINING = 7 * 24 * 3600
+
+
+def _reusable_tls_cert(cert_path, key_path):
+    """True if cert_path/key_path are a matching pair valid for a while yet.
+
+    Loading the pair into an SSLContext checks that the key matches the cert;
+    `openssl x509 -checkend` checks expiry without generating anything.
+    """
+    if not (os.path.isfile(cert_path) and os.path.isfile(key_path)):
+        return False
+    try:
+        ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(cert_path, key_path)
+        result = subprocess.run(
+            ["openssl", "x509", "-checkend", str(TLS_CERT_MIN_REMAINING),
+             "-noout", "-in", cert_path],
+            capture_output=True,
+        )
+    except (ssl.SSLError, OSError):
+        return False
+    return result.returncode == 0
+
+
+def generate_tls_certs(cert_dir="./certs", force=False):
     """Generate self-signed TLS certificate and key using openssl.
 
+    The key is ECDSA P-256: generating it is near-instant where RSA keygen
+    took most of the setup time, and every TLS client we pair with accepts
+    it. An existing server.crt/server.key pair in cert_dir is reused unless
+    force is set or it expires within a week. Reusing also keeps the
+    fingerprint that paired clients have pinned.
+
     Returns (cert_path, key_path, fingerprint) or raises on failure.
     """
     os.makedirs(cert_dir, exist_ok=True)
     cert_path = os.path.join(cert_dir, "server.crt")
     key_path = os.path.join(cert_dir, "server.key")
 
+    if not force and _reusable_tls_cert(cert_path, key_path):
+        fingerprint = get_cert_fingerprint(cert_path)
+        return os.path.abspath(cert_path), os.path.abspath(key_path), fingerprint
+
     result = subprocess.run(
         [
-            "openssl", "req", "-x509", "-newkey", "rsa:2048",
+            "openssl", "req", "-x509", "-newkey", "ec",
+            "-pkeyopt", "ec_paramgen_curve:prime256v1",
             "-keyout", key_path, "-out", cert_path,
             "-days", "365", "-nodes",
             "-subj", "/CN=chess-uci-server",
@@ -2689,9 +3191,17 @@ def generate_tls_certs(cert_dir="./certs"):
 
 
 def write_config(cfg, path="config.json"):
-    """Write config dict to JSON file with pretty formatting."""
-    with open(path, "w") as f:
-        json.dump(cfg, f, indent=2)
+    """Write config dict to JSON file with pretty formatting.
+
+    Serialized in one go (orjson when available) and written as UTF-8
+    bytes, which load_config reads back as-is.
+    """
+    if orjson is not None:
+        data = orjson.dumps(cfg, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(cfg, indent=2).encode()
+    with open(path, "wb") as f:
+        f.write(data)
     print(f"Config written to {path}")
 
 
@@ -3032,22 +3542,27 @@ async def authenticate_client_multi(reader, writer, config):
             writer.write(f"AUTH_REQUIRED {','.join(methods)}\n".encode())
         await writer.drain()
 
-        data = await asyncio.wait_for(reader.readline(), timeout=10)
+        data = await _readline_within(reader, 10)
         if not data:
             logging.warning("Auth: client disconnected before sending credentials")
             return False
 
-        client_msg = data.decode().strip()
+        raw_msg = data.strip()
+        client_msg = raw_msg.decode(errors="replace")
         logging.info(f"Auth: received '{client_msg[:30]}' (len={len(client_msg)})")
 
+        # Constant-time compares on bytes so response timing doesn't leak
+        # the secret
         # Token auth
-        if client_msg.startswith("AUTH ") and token and client_msg[5:] == token:
+        if (raw_msg.startswith(b"AUTH ") and token
+                and hmac.compare_digest(raw_msg[5:], token.encode())):
             writer.write(b"AUTH_OK\n")
             await writer.drain()
             return True
 
         # PSK auth
-        if client_msg.startswith("PSK_AUTH ") and psk and client_msg[9:] == psk:
+        if (raw_msg.startswith(b"PSK_AUTH ") and psk
+                and hmac.compare_digest(raw_msg[9:], psk.encode())):
             writer.write(b"AUTH_OK\n")
             await writer.drain()
             return True